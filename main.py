@@ -1,37 +1,244 @@
 import asyncio
-import json
+import codecs
+import collections
+import functools
+import hashlib
+import io
 import os
-import subprocess
-import textwrap
-from typing import List
-
+import posixpath
+import re
+import shlex
+import shutil
+import signal
+import time
+import uuid
+from typing import TYPE_CHECKING, Deque, List, Optional
+
+import orjson
 import streamlit as st
-from agents import Agent, Runner, function_tool, ItemHelpers
-from agents.items import (
-    ToolCallItem,
-    ToolCallOutputItem,
-    MessageOutputItem,
-    ReasoningItem,
-)
+
+# The Agents SDK (and the openai/httpx/pydantic stack behind it) is imported
+# lazily inside the functions that need it, mostly behind st.cache_resource.
+if TYPE_CHECKING:
+    from agents import Agent
+    from openai import OpenAI
 
 openai_key = os.getenv("OPENAI_API_KEY")
 if not openai_key:
     st.error("❌  OPENAI_API_KEY environment variable not found inside the container.")
     st.stop()
 
+# Written flush-left so no textwrap.dedent is needed on any rerun
+_INSTRUCTIONS = """
+You are running inside an isolated Docker container (but you can and should use docker -- you have DinD support).
+• Only files under /workdir are accessible.
+• Use the provided tools to search the web, inspect or modify files, and run shell commands for the user.
+"""
+
 WORKDIR = "/workdir"  # this is the volume the user mounts on `docker run`
+WORKDIR_WITH_SEP = WORKDIR + "/"
 
 
+@functools.lru_cache(maxsize=1024)
 def _safe_path(path: str) -> str:
     """Resolve *path* inside WORKDIR and reject escapes."""
-    abs_path = os.path.abspath(os.path.join(WORKDIR, path))
-    if not abs_path.startswith(WORKDIR):
+    abs_path = posixpath.normpath(posixpath.join(WORKDIR, path))
+    if not (abs_path == WORKDIR or abs_path.startswith(WORKDIR_WITH_SEP)):
         raise ValueError("Path escapes /workdir – forbidden")
     return abs_path
 
 
-@function_tool
-def execute_command(command: str) -> str:
+STREAM_LIMIT = 8 * 1024 * 1024  # pipe buffer for execute_command output
+READ_CHUNK_SIZE = 64 * 1024
+SHELL_METACHARS = frozenset("|&;<>$`*?[](){}~!#\\\"'\n")
+SHELL_BUILTINS = frozenset({
+    ".", ":", "alias", "bg", "cd", "command", "eval", "exec", "exit", "export",
+    "fg", "hash", "jobs", "local", "read", "readonly", "return", "set", "shift",
+    "source", "trap", "type", "ulimit", "umask", "unalias", "unset", "wait",
+})
+
+
+def _direct_exec_args(command: str):
+    """Return argv for *command* if it can skip /bin/sh, else None."""
+    if not SHELL_METACHARS.isdisjoint(command):
+        return None
+    args = shlex.split(command)
+    if not args or "=" in args[0] or args[0] in SHELL_BUILTINS:
+        return None
+    # Paths like ./run.sh are relative to WORKDIR, not our cwd -- leave them to sh
+    if "/" in args[0] or shutil.which(args[0]) is None:
+        return None  # let the shell report "not found" the usual way
+    return args
+
+
+def _output_decoder() -> io.IncrementalNewlineDecoder:
+    """UTF-8 decoder that turns \r\n and \r into \n, like Popen(text=True)."""
+    utf8 = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    return io.IncrementalNewlineDecoder(utf8, translate=True)
+
+
+# Everything str.splitlines() breaks on except \r, which the decoder already
+# turned into \n; "\n" itself is counted separately with the faster str.count.
+_RARE_LINE_BREAKS = re.compile("[\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]")
+_LINE_BREAKS = "\n\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+
+
+class _OutputWindow:
+    """Keeps only the first and last lines of a command's output in memory.
+
+    Output is buffered verbatim while a cheap line-break count says it still
+    fits the window; it is only split into lines once it outgrows it. Lines
+    are counted and split exactly like ``str.splitlines()``.
+    """
+
+    def __init__(self, keep_head: int = 50, keep_tail: int = 50):
+        self.keep_head = keep_head
+        self.keep_tail = keep_tail
+        self.head: List[str] = []
+        self.tail: Deque[str] = collections.deque(maxlen=keep_tail)
+        self.total = 0
+        self._raw: Optional[List[str]] = []
+        self._breaks = 0
+        self._partial = ""
+
+    def feed(self, chunk: str) -> None:
+        if self._raw is not None:
+            self._raw.append(chunk)
+            self._breaks += chunk.count("\n")
+            if _RARE_LINE_BREAKS.search(chunk):
+                self._breaks += len(_RARE_LINE_BREAKS.findall(chunk))
+            if self._breaks <= self.keep_head + self.keep_tail:
+                return
+            chunk = self._spill()
+        lines = (self._partial + chunk).splitlines(keepends=True)
+        self._partial = ""
+        if lines and lines[-1][-1] not in _LINE_BREAKS:
+            self._partial = lines.pop()
+        for line in lines:
+            self._add_line(line[:-1])
+
+    def _spill(self) -> str:
+        out = "".join(self._raw)
+        self._raw = None
+        return out
+
+    def _add_line(self, line: str) -> None:
+        self.total += 1
+        if len(self.head) < self.keep_head:
+            self.head.append(line)
+        else:
+            self.tail.append(line)
+
+    def render(self) -> str:
+        if self._raw is not None:
+            out = self._spill()
+            lines = self._breaks + (bool(out) and out[-1] not in _LINE_BREAKS)
+            if lines <= self.keep_head + self.keep_tail:
+                return out
+            self.feed(out)
+        if self._partial:
+            self._add_line(self._partial)
+            self._partial = ""
+
+        omitted = self.total - self.keep_head - self.keep_tail
+        truncated_output = (
+                self.head
+                + [f"... [truncated {omitted} lines] ..."]
+                + list(self.tail)
+        )
+        return "\n".join(truncated_output)
+
+
+def _kill_process_group(proc) -> None:
+    """SIGKILL *proc* and everything it spawned (it leads its own session)."""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+class ShellServer:
+    """
+    One long-lived bash child that forks a subshell for each command.
+
+    Each command is sent as a single quoted word, ``( eval 'command' )
+    </dev/null``, followed by a printf of a fresh random sentinel; output is
+    read in chunks until that sentinel shows up. Quoting means a malformed
+    command -- an unclosed quote, ``$(`` or ``do`` -- only fails its own eval
+    and can never swallow the sentinel. The subshell keeps every command
+    isolated: cd, exported variables, set -o, aliases, traps, umask, exit
+    and exec all die with it, so nothing leaks into the next command.
+
+    If a read fails or the tool call is cancelled, the whole process group
+    is killed and a fresh shell is spawned next time -- the pipe is never
+    left holding a half-read response.
+    """
+
+    def __init__(self):
+        self._proc = None
+        self._lock = asyncio.Lock()
+
+    def accepts(self, command: str) -> bool:
+        return not self._lock.locked()  # busy -- parallel calls get a one-off shell
+
+    async def run(self, command: str, window: _OutputWindow) -> None:
+        async with self._lock:
+            try:
+                await self._run(command, window)
+            except BaseException:
+                self._reset()
+                raise
+
+    def _reset(self) -> None:
+        if self._proc is not None:
+            _kill_process_group(self._proc)
+            self._proc = None
+
+    async def _run(self, command: str, window: _OutputWindow) -> None:
+        if self._proc is None or self._proc.returncode is not None:
+            self._proc = await asyncio.create_subprocess_exec(
+                "bash",
+                cwd=WORKDIR,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+                limit=STREAM_LIMIT,
+                start_new_session=True,
+            )
+        sentinel = f"__END_{uuid.uuid4().hex}__"
+        script = (
+            f"( eval {shlex.quote(command)} ) </dev/null 2>&1\n"
+            f"printf '%s' {sentinel}\n"
+        )
+        self._proc.stdin.write(script.encode("utf-8"))
+        await self._proc.stdin.drain()
+
+        marker = sentinel.encode("ascii")
+        keep = len(marker) - 1  # a chunk may end partway through the sentinel
+        decoder = _output_decoder()
+        pending = b""
+        while chunk := await self._proc.stdout.read(READ_CHUNK_SIZE):
+            pending += chunk
+            idx = pending.find(marker)
+            if idx != -1:
+                window.feed(decoder.decode(pending[:idx], final=True))
+                return
+            if len(pending) > keep:
+                window.feed(decoder.decode(pending[:-keep]))
+                pending = pending[-keep:]
+        window.feed(decoder.decode(pending, final=True))
+        await self._proc.wait()  # the shell itself died mid-command
+        self._proc = None
+
+
+def get_shell_server() -> ShellServer:
+    """Per session: the shell's pipes belong to the session's event loop."""
+    if "shell_server" not in st.session_state:
+        st.session_state.shell_server = ShellServer()
+    return st.session_state.shell_server
+
+
+async def execute_command(command: str) -> str:
     """
     Run *command* inside /workdir and return the combined output.
 
@@ -41,102 +248,494 @@ def execute_command(command: str) -> str:
 
         ... [truncated 245 lines] ...
     """
-    proc = subprocess.Popen(
-        command,
-        shell=True,
+    # Only the head/tail window is ever held in memory, however verbose the command
+    window = _OutputWindow()
+    args = _direct_exec_args(command)
+    shell = get_shell_server()
+    if args is None and shell.accepts(command):
+        await shell.run(command, window)
+        return window.render()
+
+    spawn_kwargs = dict(
         cwd=WORKDIR,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        limit=STREAM_LIMIT,
+        start_new_session=True,
     )
-    out, _ = proc.communicate()
+    if args is None:
+        proc = await asyncio.create_subprocess_shell(command, **spawn_kwargs)
+    else:
+        proc = await asyncio.create_subprocess_exec(*args, **spawn_kwargs)
+    try:
+        decoder = _output_decoder()
+        while chunk := await proc.stdout.read(READ_CHUNK_SIZE):
+            window.feed(decoder.decode(chunk))
+        window.feed(decoder.decode(b"", final=True))
+        await proc.wait()
+    except BaseException:
+        _kill_process_group(proc)  # cancelled tool call: don't leave it running
+        raise
+    return window.render()
 
-    lines: List[str] = out.splitlines()
-    if len(lines) <= 100:
-        return out
 
-    keep_head = 50
-    keep_tail = 50
-    omitted = len(lines) - keep_head - keep_tail
-    truncated_output = (
-            lines[:keep_head]
-            + [f"... [truncated {omitted} lines] ..."]
-            + lines[-keep_tail:]
-    )
-    return "\n".join(truncated_output)
+@st.cache_resource
+def get_content_hashes() -> dict:
+    """abs_path -> (sha256, size, mtime_ns, inode) of the last write_file there."""
+    return {}
+
+
+def _file_signature(digest: str, st_result: os.stat_result) -> tuple:
+    return digest, st_result.st_size, st_result.st_mtime_ns, st_result.st_ino
+
 
+def _write_sync(abs_path: str, content: str, hashes: dict) -> bool:
+    """Write *content* to *abs_path*; return False if it was already there.
 
-@function_tool
-def write_file(path: str, content: str) -> str:
+    The hash is only trusted while the file's stat still matches our last
+    write, so edits made by execute_command or the user are never masked.
+    """
+    raw = content.encode("utf-8")
+    digest = hashlib.sha256(raw).hexdigest()
+    known = hashes.get(abs_path)
+    if known is not None and known[0] == digest:
+        try:
+            if _file_signature(digest, os.stat(abs_path)) == known:
+                return False
+        except FileNotFoundError:
+            pass
+
+    os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+    data = memoryview(raw)
+    fd = os.open(abs_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+        hashes[abs_path] = _file_signature(digest, os.fstat(fd))
+    finally:
+        os.close(fd)
+    return True
+
+
+def _read_sync(abs_path: str) -> str:
+    # Read straight into a buffer sized from fstat -- no realloc churn in the
+    # common case -- but keep going until EOF, since pseudo-files report a
+    # size of 0 and a file may grow while we read it.
+    fd = os.open(abs_path, os.O_RDONLY)
+    try:
+        buf = bytearray(os.fstat(fd).st_size + 1)  # +1 so EOF is seen without growing
+        n = 0
+        while True:
+            if n == len(buf):
+                buf.extend(bytes(max(len(buf), READ_CHUNK_SIZE)))
+            with memoryview(buf) as view:
+                read = os.readv(fd, [view[n:]])
+            if not read:
+                break
+            n += read
+    finally:
+        os.close(fd)
+    del buf[n:]
+    text = buf.decode("utf-8")
+    if "\r" in text:  # same universal-newline translation as open(..., "r")
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+async def write_file(path: str, content: str) -> str:
     """Create or overwrite *path* inside /workdir with *content*."""
     abs_path = _safe_path(path)
-    os.makedirs(os.path.dirname(abs_path), exist_ok=True)
-    with open(abs_path, "w", encoding="utf-8") as f:
-        f.write(content)
+    written = await asyncio.to_thread(
+        _write_sync, abs_path, content, get_content_hashes()
+    )
+    if not written:
+        return f"No change to {path}"
     return f"Wrote {len(content)} bytes to {path}"
 
 
-@function_tool
-def read_file(path: str) -> str:
+async def read_file(path: str) -> str:
     """Return the full contents of *path* inside /workdir."""
     abs_path = _safe_path(path)
-    with open(abs_path, "r", encoding="utf-8") as f:
-        return f.read()
-
-
-assistant = Agent(
-    name="Simple DinD CLI Assistant",
-    model="o4-mini",
-    instructions=textwrap.dedent(
-        """
-        You are running inside an isolated Docker container (but you can and should use docker -- you have DinD support).
-        • Only files under /workdir are accessible.
-        • Use the provided tools to search the web, inspect or modify files, and run shell commands for the user.
-        """
-    ),
-    tools=[
-        execute_command,
-        write_file,
-        read_file,
-    ],
-)
-
-
-def _append_and_render(role: str, content: str):
-    """Utility: store a message in session_state and render it immediately."""
-    st.session_state.history.append({"role": role, "content": content})
+    return await asyncio.to_thread(_read_sync, abs_path)
+
+
+@st.cache_resource
+def get_assistant() -> "Agent":
+    """Build the agent once per process; Streamlit reruns reuse the same instance."""
+    from agents import Agent, ModelSettings, function_tool
+
+    return Agent(
+        name="Simple DinD CLI Assistant",
+        model="o4-mini",
+        instructions=_INSTRUCTIONS,
+        # Explicit only -- the Responses API already defaults to this. Calls from
+        # one response overlap because the tools are async and the SDK gathers them
+        model_settings=ModelSettings(parallel_tool_calls=True),
+        tools=[
+            function_tool(execute_command),
+            function_tool(write_file),
+            function_tool(read_file),
+        ],
+    )
+
+
+assistant = get_assistant()
+
+
+@st.cache_resource
+def get_openai_client() -> "OpenAI":
+    """Plain OpenAI client for the helper calls made outside the Agents SDK."""
+    from openai import OpenAI
+
+    return OpenAI()
+
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_TIMEOUT = 2.0  # seconds; past this the cache lookup counts as a miss
+SEMANTIC_CACHE_THRESHOLD = 0.9  # cosine similarity needed to reuse an answer
+SEMANTIC_CACHE_CONTEXT_ITEMS = 6  # trailing conversation items that must match
+SEMANTIC_CACHE_MAX_ENTRIES = 256  # per (model, tools, context) bucket
+
+_FILLER_WORDS = re.compile(r"\b(please|pls|kindly)\b")
+
+
+def _canonicalize_prompt(prompt: str) -> str:
+    """Lowercase *prompt*, drop politeness fillers and collapse whitespace."""
+    return " ".join(_FILLER_WORDS.sub(" ", prompt.lower()).split())
+
+
+class _CachedRun:
+    """Stand-in for a finished RunResultStreaming replayed from the cache."""
+
+    def __init__(self, input_data, new_items):
+        self.new_items = new_items
+        self._input_data = input_data
+
+    def to_input_list(self):
+        return list(self._input_data) + [
+            item.to_input_item() for item in self.new_items
+        ]
+
+
+class SemanticCache:
+    """
+    Reuse agent answers for prompts semantically identical to earlier ones.
+
+    Entries are bucketed by (model, tool-set fingerprint, trailing conversation
+    context); inside a bucket the canonicalized prompt is matched exactly first
+    and then by embedding cosine similarity. Only runs that made no tool calls
+    are stored -- tool results depend on the current state of /workdir, so
+    replaying them could silently hide changes.
+
+    Embeddings are fetched lazily, together with the query, and only when the
+    bucket has entries but no exact match -- an empty bucket (the usual case
+    once a conversation has moved on) costs no round trip. The cache is only
+    an optimization, so embedding failures count as a miss.
+    """
+
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD):
+        self.threshold = threshold
+        self._client = get_openai_client()
+        # bucket key -> [canonical prompt, embedding or None, new_items]
+        self._buckets: dict[str, list[list]] = {}
+
+    @staticmethod
+    def bucket_key(agent: "Agent", context) -> str:
+        tools = ",".join(sorted(tool.name for tool in agent.tools))
+        ctx = orjson.dumps(
+            context[-SEMANTIC_CACHE_CONTEXT_ITEMS:],
+            option=orjson.OPT_SORT_KEYS,
+            default=str,
+        )
+        header = f"{agent.model}|{tools}|".encode()
+        return hashlib.sha256(header + ctx).hexdigest()
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        # Short timeout and no retries: a slow embedding is just a cache miss
+        client = self._client.with_options(
+            timeout=EMBEDDING_TIMEOUT, max_retries=0
+        )
+        resp = client.embeddings.create(model=EMBEDDING_MODEL, input=texts)
+        return [d.embedding for d in resp.data]
+
+    def lookup(self, key: str, canonical: str):
+        """Return cached new_items for *canonical*, or None. Blocks on the network."""
+        from openai import OpenAIError
+
+        # Snapshot: other sessions may store() into the same bucket while this
+        # thread waits on the network, and their entries have no embedding yet
+        entries = list(self._buckets.get(key, ()))
+        if not entries:
+            return None
+        for text, _, new_items in entries:
+            if text == canonical:
+                return new_items
+
+        missing = [entry for entry in entries if entry[1] is None]
+        try:
+            embeddings = self.embed([canonical] + [entry[0] for entry in missing])
+        except OpenAIError:
+            return None
+        query = embeddings[0]
+        for entry, emb in zip(missing, embeddings[1:]):
+            entry[1] = emb
+
+        best_items, best_score = None, self.threshold
+        for _, emb, new_items in entries:
+            # OpenAI embeddings are unit-length, so the dot product is the cosine
+            score = sum(a * b for a, b in zip(emb, query))
+            if score >= best_score:
+                best_items, best_score = new_items, score
+        return best_items
+
+    def store(self, key: str, canonical: str, new_items):
+        from agents.items import ToolCallItem
+
+        if any(isinstance(item, ToolCallItem) for item in new_items):
+            return
+        bucket = self._buckets.setdefault(key, [])
+        bucket.append([canonical, None, list(new_items)])
+        del bucket[:-SEMANTIC_CACHE_MAX_ENTRIES]
+
+
+@st.cache_resource
+def get_semantic_cache() -> SemanticCache:
+    return SemanticCache()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """One long-lived event loop per browser session, reused by every turn.
+
+    Only that session's script thread ever drives it, so sessions never wait
+    on each other and no lock is needed.
+    """
+    if "loop" not in st.session_state:
+        st.session_state.loop = asyncio.new_event_loop()
+    return st.session_state.loop
+
+
+def _cancel_leftover_tasks(loop: asyncio.AbstractEventLoop) -> None:
+    """Cancel whatever an abandoned turn left pending on *loop*.
+
+    Without this, a turn interrupted by a new prompt or Stop would resume on
+    the next run_until_complete and keep calling the model and the tools.
+    """
+    tasks = [task for task in asyncio.all_tasks(loop) if not task.done()]
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+
+MAX_VERBATIM_TURNS = 10  # most recent user turns always sent to the model as-is
+SUMMARY_MODEL = "gpt-4.1-mini"
+SUMMARY_ITEM_CHARS = 2000  # per-item cap when building the summary transcript
+
+
+def _item_text(item) -> str:
+    """Flatten one Agents-SDK input item into a transcript line for summarizing."""
+    item_type = item.get("type", "message")
+    if item_type == "message":
+        content = item.get("content")
+        if not isinstance(content, str):
+            content = " ".join(part.get("text", "") for part in content or [])
+        text = f"{item.get('role')}: {content}"
+    elif item_type == "function_call":
+        text = f"tool call {item.get('name')}: {item.get('arguments')}"
+    elif item_type == "function_call_output":
+        text = f"tool result: {item.get('output')}"
+    else:
+        return ""
+    return text[:SUMMARY_ITEM_CHARS]
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _summarize_transcript(transcript: str) -> str:
+    resp = get_openai_client().responses.create(
+        model=SUMMARY_MODEL,
+        instructions=(
+            "Summarize this conversation between a user and a CLI agent. Keep "
+            "every fact needed to continue the work: goals, decisions, file "
+            "paths, commands run and their outcomes."
+        ),
+        input=transcript,
+    )
+    return resp.output_text
+
+
+def _compact_conversation(conversation: list) -> list:
+    """
+    Fold all but the last MAX_VERBATIM_TURNS user turns into one summary message.
+
+    Compaction only kicks in once the conversation holds twice that many turns,
+    so the summary -- and with it the prompt prefix OpenAI can cache -- stays
+    unchanged for the next MAX_VERBATIM_TURNS turns. Cuts are made at user
+    messages so tool calls are never separated from their results.
+    """
+    from openai import OpenAIError
+
+    turn_starts = [
+        i for i, item in enumerate(conversation) if item.get("role") == "user"
+    ]
+    if len(turn_starts) <= 2 * MAX_VERBATIM_TURNS:
+        return conversation
+
+    cut = turn_starts[-MAX_VERBATIM_TURNS]
+    transcript = "\n".join(
+        filter(None, (_item_text(item) for item in conversation[:cut]))
+    )
+    try:
+        summary = _summarize_transcript(transcript)
+    except OpenAIError:
+        return conversation  # keep everything verbatim; retried next turn
+    return [
+        {"role": "system", "content": f"Summary of earlier turns:\n{summary}"}
+    ] + conversation[cut:]
+
+
+UI_FLUSH_INTERVAL = 0.05  # seconds between UI flushes (~20 Hz)
+
+
+def _append_and_render(role: str, content: str, entries: list):
+    """Utility: store a message in *entries* and render it immediately.
+
+    *entries* is either session_state.history itself or a per-turn buffer
+    that is merged into it once the turn ends.
+    """
+    entries.append({"role": role, "content": content})
     st.chat_message(role).markdown(content)
 
 
-def _render_stream_event(event):
+def _reasoning_text(raw_item) -> str:
+    summary = getattr(raw_item, "summary", None)
+    if summary:
+        return "\n".join(part.text for part in summary)
+    return str(raw_item)
+
+
+def _render_reasoning(content: str) -> None:
+    with st.expander("Reasoning"):
+        st.code(content, language=None)
+
+
+def _reasoning_entry(pending_reasoning: list) -> Optional[dict]:
+    """Combine the turn's queued reasoning into one history entry, if any."""
+    if not pending_reasoning:
+        return None
+    content = "\n---\n".join(_reasoning_text(r) for r in pending_reasoning)
+    return {"role": "reasoning", "content": content}
+
+
+def _render_stream_event(event, entries: list, pending_reasoning: list):
     """Handle one streaming event coming from Runner.run_streamed."""
+    from agents import ItemHelpers
+    from agents.items import (
+        ToolCallItem,
+        ToolCallOutputItem,
+        MessageOutputItem,
+        ReasoningItem,
+    )
+
     if event.type == "run_item_stream_event":
         item = event.item
         if isinstance(item, ToolCallItem):
+            arguments = orjson.dumps(
+                item.raw_item.arguments, option=orjson.OPT_INDENT_2
+            ).decode()
             content = (
-                f"🔧 **Tool call** `{item.raw_item.name}`\n```json\n{json.dumps(item.raw_item.arguments, indent=2)}\n```"
+                f"🔧 **Tool call** `{item.raw_item.name}`\n```json\n{arguments}\n```"
             )
-            _append_and_render("tool", content)
+            _append_and_render("tool", content, entries)
         elif isinstance(item, ToolCallOutputItem):
             content = f"📤 **Tool result**\n```\n{item.output}\n```"
-            _append_and_render("tool_result", content)
+            _append_and_render("tool_result", content, entries)
         elif isinstance(item, MessageOutputItem):
             content = f"🤖 **LLM message**\n```\n{ItemHelpers.text_message_output(item)}\n```"
-            _append_and_render("assistant", content)
+            _append_and_render("assistant", content, entries)
         elif isinstance(item, ReasoningItem):
-            _append_and_render("reasoning", item.raw_item)
+            pending_reasoning.append(item.raw_item)  # shown after the turn
     elif event.type == "agent_updated_stream_event":
         pass
 
 
 async def _run_agent_and_stream(input_data, max_turns: int = 40):
-    """Run the agent and push UI updates *while* it is running."""
+    """Run the agent and push UI updates *while* it is running.
+
+    Prompts the semantic cache has already answered are replayed from it
+    instead of hitting the model again. Rendered messages are buffered and
+    written to session_state.history in one go when the turn ends; reasoning
+    is held back until then and shown collapsed.
+    """
+    new_entries: list[dict] = []
+    pending_reasoning: list = []
+    try:
+        return await _stream_turn(
+            input_data, new_entries, pending_reasoning, max_turns
+        )
+    finally:
+        reasoning = _reasoning_entry(pending_reasoning)
+        if reasoning is not None:
+            new_entries.append(reasoning)
+        # Store before rendering: after Stop every st.* call raises again
+        st.session_state.history.extend(new_entries)
+        if reasoning is not None:
+            _render_reasoning(reasoning["content"])
+
+
+async def _stream_turn(
+    input_data, new_entries: list, pending_reasoning: list, max_turns: int
+):
+    from agents import Runner
+    from agents.items import ReasoningItem, ToolCallItem, ToolCallOutputItem
+    from agents.stream_events import RunItemStreamEvent
+
+    cache = get_semantic_cache()
+    key = cache.bucket_key(assistant, input_data[:-1])
+    canonical = _canonicalize_prompt(input_data[-1]["content"])
+
+    cached_items = await asyncio.to_thread(cache.lookup, key, canonical)
+    if cached_items is not None:
+        for item in cached_items:
+            name = (
+                "reasoning_item_created"
+                if isinstance(item, ReasoningItem)
+                else "message_output_created"
+            )
+            _render_stream_event(
+                RunItemStreamEvent(name=name, item=item),
+                new_entries,
+                pending_reasoning,
+            )
+        return _CachedRun(input_data, cached_items)
+
     result_streaming = Runner.run_streamed(
         assistant, input_data, max_turns=max_turns
     )
-    async for ev in result_streaming.stream_events():
-        _render_stream_event(ev)
-        await asyncio.sleep(0)  # let Streamlit refresh
+    pending = []
+    last_flush_ts = time.monotonic()
+    try:
+        async for ev in result_streaming.stream_events():
+            # Token-level raw events are never rendered; only item events are queued
+            terminal = False
+            if ev.type == "run_item_stream_event":
+                pending.append(ev)
+                terminal = isinstance(ev.item, (ToolCallItem, ToolCallOutputItem))
+            if not pending:
+                continue
+            now = time.monotonic()
+            if terminal or now - last_flush_ts >= UI_FLUSH_INTERVAL:
+                for pending_ev in pending:
+                    _render_stream_event(pending_ev, new_entries, pending_reasoning)
+                pending.clear()
+                last_flush_ts = now
+                await asyncio.sleep(0)  # let Streamlit refresh
+        for pending_ev in pending:
+            _render_stream_event(pending_ev, new_entries, pending_reasoning)
+    except BaseException:
+        # Rerun/Stop raised from an st.* call, or a failure: stop the SDK run too
+        result_streaming.cancel()
+        raise
+    cache.store(key, canonical, result_streaming.new_items)
     return result_streaming
 
 
@@ -153,13 +752,16 @@ if "conversation" not in st.session_state:
 
 # Render prior chat history (UI)
 for msg in st.session_state.history:
+    if msg["role"] == "reasoning":
+        _render_reasoning(msg["content"])
+        continue
     st.chat_message(msg["role"]).markdown(msg["content"])
 
 # New user prompt
 prompt = st.chat_input("Type a request…")
 if prompt:
     # Show the user message immediately (UI only)
-    _append_and_render("user", prompt)
+    _append_and_render("user", prompt, st.session_state.history)
 
     # ----- Build input list the agent should see -----
     input_list = st.session_state.conversation + [
@@ -168,10 +770,18 @@ if prompt:
 
     # ----- Run the agent, streaming events in real-time -----
     with st.spinner("Running agent…"):
-        result = asyncio.run(_run_agent_and_stream(input_list, max_turns=40))
+        loop = get_loop()
+        try:
+            result = loop.run_until_complete(
+                _run_agent_and_stream(input_list, max_turns=40)
+            )
+        finally:
+            _cancel_leftover_tasks(loop)
 
-    # ----- Save updated conversation for the next turn -----
-    st.session_state.conversation = result.to_input_list()
+        # ----- Save updated conversation for the next turn -----
+        st.session_state.conversation = _compact_conversation(
+            result.to_input_list()
+        )
 
     # Optional: show trace
     if hasattr(result, "trace_spans") and result.trace_spans:
@@ -179,8 +789,7 @@ if prompt:
             trace_md = [span.to_markdown() for span in result.trace_spans]
             st.markdown(" ".join(trace_md))
 
-    # Rerun so that history (now fully updated) is rendered from scratch
-    st.rerun()
+    # No st.rerun(): every message was already rendered live while streaming
 
 if __name__ == "__main__":
     # Running inside `streamlit run` automatically executes the script